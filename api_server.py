@@ -10,12 +10,17 @@
 либо использует явно заданный LLM_BACKEND_URL.
 """
 
+import asyncio
+import hmac
 import os
-from typing import AsyncIterator, Optional
+import time
+from typing import AsyncIterator
 
 import httpx
-from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 app = FastAPI(title="LLM Proxy", version="2.0.0")
 
@@ -33,6 +38,50 @@ BACKEND_URLS = {
 # Ollama использует другой путь для OpenAI-совместимого API
 OLLAMA_OPENAI_PREFIX = "/v1"
 
+# Заголовки, которые не пересылаются backend'у: hop-by-hop (RFC 7230)
+# и host, который httpx выставит сам. Content-Length сохраняется, чтобы тело
+# запроса уходило потоком без перехода на chunked.
+# Байтовые имена сравниваются с request.headers.raw напрямую: ASGI-серверы
+# (uvicorn) передают имена заголовков в нижнем регистре
+HOP_BY_HOP_HEADERS = frozenset({
+    b"host",
+    b"connection",
+    b"keep-alive",
+    b"proxy-authenticate",
+    b"proxy-authorization",
+    b"te",
+    b"trailer",
+    b"transfer-encoding",
+    b"upgrade",
+})
+
+# Для методов без тела запроса Content-Length тоже не пересылается:
+# тело клиента (если было) backend'у не отправляется
+BODYLESS_DROP_HEADERS = HOP_BY_HOP_HEADERS | {b"content-length"}
+
+# Пути OpenAI-совместимого API, проксируемые к backend'у.
+# Все три backend'а поддерживают стандартные /v1/* пути
+PROXY_PATHS = (
+    "/v1/chat/completions",
+    "/v1/completions",
+    "/v1/models",
+    "/v1/embeddings",
+)
+
+# Методы без тела запроса
+BODYLESS_METHODS = frozenset({"GET", "HEAD", "DELETE"})
+
+# Параметры пула соединений к backend'у
+UPSTREAM_LIMITS = httpx.Limits(
+    max_connections=1000,
+    max_keepalive_connections=100,
+    keepalive_expiry=15.0,
+)
+
+# Таймауты запросов к backend'у: чтение без ограничения — генерация
+# может идти долго
+UPSTREAM_TIMEOUT = httpx.Timeout(connect=10.0, read=None, write=30.0, pool=30.0)
+
 
 def _get_llm_backend() -> str:
     """Возвращает выбранный backend (vllm, ollama, llamacpp)."""
@@ -52,6 +101,29 @@ def _get_backend_base_url() -> str:
     return BACKEND_URLS.get(backend, BACKEND_URLS["vllm"])
 
 
+def _get_backend_http2() -> bool:
+    """
+    Включён ли HTTP/2 к backend'у (LLM_BACKEND_HTTP2=1).
+    Для https-URL протокол согласуется через ALPN, для http — остаётся HTTP/1.1.
+    """
+    return os.getenv("LLM_BACKEND_HTTP2", "").strip().lower() in ("1", "true", "yes")
+
+
+def _get_models_cache_ttl() -> float:
+    """Возвращает TTL кэша /v1/models в секундах (0 — кэш выключен)."""
+    return float(os.getenv("MODELS_CACHE_TTL", "").strip() or 30)
+
+
+def _get_deep_health_ttl() -> float:
+    """Возвращает TTL кэша /health/deep в секундах (0 — кэш выключен)."""
+    return float(os.getenv("DEEP_HEALTH_TTL", "").strip() or 2)
+
+
+def _get_max_connections() -> int:
+    """Возвращает лимит одновременных запросов к прокси на воркер (0 — без лимита)."""
+    return int(os.getenv("MAX_CONNECTIONS", "").strip() or 1000)
+
+
 def _get_api_key() -> str:
     """Возвращает API-ключ для авторизации (если задан)."""
     return os.getenv("API_KEY", "").strip()
@@ -62,34 +134,126 @@ def _get_served_model_name() -> str:
     return os.getenv("SERVED_MODEL_NAME", "local-model").strip()
 
 
+# =============================================================================
+# Жизненный цикл
+# =============================================================================
+
+@app.on_event("startup")
+async def _startup() -> None:
+    """
+    Читает конфигурацию из окружения один раз и создаёт общий httpx-клиент
+    с пулом соединений к backend'у (опционально HTTP/2).
+    """
+    app.state.backend = _get_llm_backend()
+    app.state.base_url = _get_backend_base_url()
+    api_key = _get_api_key()
+    app.state.auth_enabled = bool(api_key)
+    app.state.api_key_b = api_key.encode()
+    app.state.served_model_name = _get_served_model_name()
+
+    # Полные URL backend'а для каждого проксируемого пути
+    app.state.routes = {path: app.state.base_url + path for path in PROXY_PATHS}
+
+    # Кэш /v1/models: (время, тело, content-type, статус)
+    app.state.models_cache_ttl = _get_models_cache_ttl()
+    app.state.models_cache = None
+    app.state.models_lock = asyncio.Lock()
+
+    # Кэш /health/deep: (время, статус, тело)
+    app.state.deep_health_ttl = _get_deep_health_ttl()
+    app.state.deep_cache = None
+    app.state.deep_lock = asyncio.Lock()
+
+    app.state.client = httpx.AsyncClient(
+        base_url=app.state.base_url,
+        timeout=UPSTREAM_TIMEOUT,
+        limits=UPSTREAM_LIMITS,
+        http2=_get_backend_http2(),
+    )
+
+
+@app.on_event("shutdown")
+async def _shutdown() -> None:
+    """Закрывает общий httpx-клиент."""
+    await app.state.client.aclose()
+
+
 # =============================================================================
 # Авторизация
 # =============================================================================
 
-def _auth_or_401(authorization: Optional[str]) -> None:
-    """Проверяет Bearer-токен, если API_KEY задан."""
-    expected = _get_api_key()
-    if not expected:
+def _auth_or_401(request: Request) -> None:
+    """
+    Проверяет Bearer-токен (за постоянное время), если API_KEY задан.
+    Без API_KEY заголовок Authorization не разбирается вовсе.
+    """
+    if not request.app.state.auth_enabled:
         return
+    authorization = request.headers.get("authorization")
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Отсутствует Bearer-токен")
-    token = authorization.removeprefix("Bearer ").strip()
-    if token != expected:
+    token = authorization[7:].strip().encode()
+    if not hmac.compare_digest(token, request.app.state.api_key_b):
         raise HTTPException(status_code=401, detail="Неверный токен")
 
 
+# =============================================================================
+# Ограничение нагрузки
+# =============================================================================
+
+class ConnectionLimitMiddleware:
+    """
+    Отвечает 503 сверх MAX_CONNECTIONS одновременных запросов.
+    /health* и /config не ограничиваются; MAX_CONNECTIONS=0 снимает лимит.
+
+    Реализован как ASGI-middleware, а не BaseHTTPMiddleware: запрос считается
+    активным до конца отдачи тела, включая потоковые ответы.
+    """
+
+    EXEMPT_PREFIXES = ("/health", "/config")
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self.active = 0
+        self.limit = _get_max_connections()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"].startswith(self.EXEMPT_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        if 0 < self.limit <= self.active:
+            response = JSONResponse(
+                {"error": "overloaded"},
+                status_code=503,
+                headers={"Retry-After": "1"},
+            )
+            await response(scope, receive, send)
+            return
+
+        # Проверка и инкремент без await между ними — гонки в event loop нет
+        self.active += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.active -= 1
+
+
+app.add_middleware(ConnectionLimitMiddleware)
+
+
 # =============================================================================
 # Health check
 # =============================================================================
 
 @app.get("/health")
-async def health() -> JSONResponse:
+async def health(request: Request) -> JSONResponse:
     """
     Проверка здоровья прокси.
     Для глубокой проверки можно добавить запрос к backend'у.
     """
-    backend = _get_llm_backend()
-    base_url = _get_backend_base_url()
+    backend = request.app.state.backend
+    base_url = request.app.state.base_url
     return JSONResponse({
         "status": "ok",
         "backend": backend,
@@ -98,12 +262,33 @@ async def health() -> JSONResponse:
 
 
 @app.get("/health/deep")
-async def health_deep() -> JSONResponse:
+async def health_deep(request: Request) -> JSONResponse:
     """
     Глубокая проверка: пингует backend.
+    Результат кэшируется на DEEP_HEALTH_TTL секунд, чтобы частые пробы
+    оркестратора не нагружали backend.
     """
-    backend = _get_llm_backend()
-    base_url = _get_backend_base_url()
+    state = request.app.state
+    ttl = state.deep_health_ttl
+
+    cached = state.deep_cache
+    if cached is None or time.monotonic() - cached[0] >= ttl:
+        async with state.deep_lock:
+            cached = state.deep_cache
+            if cached is None or time.monotonic() - cached[0] >= ttl:
+                status_code, body = await _check_backend(request)
+                cached = (time.monotonic(), status_code, body)
+                state.deep_cache = cached
+
+    _, status_code, body = cached
+    return JSONResponse(body, status_code=status_code)
+
+
+async def _check_backend(request: Request) -> tuple[int, dict]:
+    """Пингует health endpoint backend'а через общий клиент."""
+    backend = request.app.state.backend
+    base_url = request.app.state.base_url
+    client: httpx.AsyncClient = request.app.state.client
 
     # Определяем health endpoint для каждого backend'а
     health_paths = {
@@ -114,23 +299,22 @@ async def health_deep() -> JSONResponse:
     health_path = health_paths.get(backend, "/health")
 
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            resp = await client.get(f"{base_url}{health_path}")
-            backend_ok = resp.status_code == 200
+        resp = await client.get(f"{base_url}{health_path}", timeout=2.0)
+        backend_ok = resp.status_code == 200
     except Exception as e:
-        return JSONResponse({
+        return 503, {
             "status": "unhealthy",
             "backend": backend,
             "backend_url": base_url,
             "error": str(e),
-        }, status_code=503)
+        }
 
-    return JSONResponse({
+    return 200 if backend_ok else 503, {
         "status": "ok" if backend_ok else "unhealthy",
         "backend": backend,
         "backend_url": base_url,
         "backend_status": resp.status_code,
-    }, status_code=200 if backend_ok else 503)
+    }
 
 
 # =============================================================================
@@ -138,62 +322,73 @@ async def health_deep() -> JSONResponse:
 # =============================================================================
 
 async def _stream_bytes(resp: httpx.Response) -> AsyncIterator[bytes]:
-    """Итератор для потоковой передачи байтов."""
-    async for chunk in resp.aiter_bytes():
+    """
+    Итератор для потоковой передачи байтов.
+    Байты отдаются как есть (без декодирования Content-Encoding) и без
+    перебуферизации: chunk_size в httpx копит данные до заданного размера,
+    что задерживало бы SSE-события.
+    """
+    async for chunk in resp.aiter_raw():
         if chunk:
             yield chunk
 
 
-def _adjust_path_for_backend(path: str, backend: str) -> str:
-    """
-    Корректирует путь для разных backend'ов.
-    Ollama и llama.cpp используют стандартные /v1/* пути.
-    """
-    # Все три backend'а поддерживают /v1/* пути
-    return path
+async def _proxy(request: Request, url: str) -> Response:
+    """Проверяет авторизацию и проксирует запрос к backend'у по готовому URL."""
+    _auth_or_401(request)
+    return await _forward(request, url)
 
 
-async def _proxy(request: Request, path: str, authorization: Optional[str]) -> Response:
-    """Проксирует запрос к выбранному backend'у."""
-    _auth_or_401(authorization)
-
-    backend = _get_llm_backend()
-    base_url = _get_backend_base_url()
-    adjusted_path = _adjust_path_for_backend(path, backend)
-    url = f"{base_url}{adjusted_path}"
+async def _forward(request: Request, url: str) -> Response:
+    """Проксирует запрос к выбранному backend'у (авторизация уже проверена)."""
+    backend = request.app.state.backend
 
-    body = await request.body()
-    headers = dict(request.headers)
-    # Удаляем заголовки, которые httpx выставит сам
-    headers.pop("host", None)
-    headers.pop("content-length", None)
+    if request.method in BODYLESS_METHODS:
+        content = None
+        drop_headers = BODYLESS_DROP_HEADERS
+    else:
+        content = request.stream()
+        drop_headers = HOP_BY_HOP_HEADERS
+    headers = [(k, v) for k, v in request.headers.raw if k not in drop_headers]
 
-    timeout = httpx.Timeout(connect=10.0, read=None, write=30.0, pool=30.0)
+    client: httpx.AsyncClient = request.app.state.client
 
     try:
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            resp = await client.stream(
-                request.method,
-                url,
-                content=body if body else None,
-                headers=headers,
-                params=request.query_params,
+        upstream_request = client.build_request(
+            request.method,
+            url,
+            content=content,
+            headers=headers,
+            params=request.query_params,
+        )
+        resp = await client.send(upstream_request, stream=True)
+
+        content_type = resp.headers.get("content-type", "application/json")
+        transfer_encoding = resp.headers.get("transfer-encoding", "").lower()
+        status_code = resp.status_code
+
+        # Потоковые ответы (SSE, chunked, без Content-Length) отдаём без
+        # буферизации; соединение вернётся в пул после отдачи тела
+        if (
+            "text/event-stream" in content_type.lower()
+            or "chunked" in transfer_encoding
+            or "content-length" not in resp.headers
+        ):
+            content_encoding = resp.headers.get("content-encoding")
+            return StreamingResponse(
+                _stream_bytes(resp),
+                status_code=status_code,
+                media_type=content_type,
+                headers={"content-encoding": content_encoding} if content_encoding else None,
+                background=BackgroundTask(resp.aclose),
             )
 
-            content_type = resp.headers.get("content-type", "application/json")
-            status_code = resp.status_code
-
-            # Потоковые ответы (SSE)
-            if "text/event-stream" in content_type.lower():
-                return StreamingResponse(
-                    _stream_bytes(resp),
-                    status_code=status_code,
-                    media_type=content_type,
-                )
-
-            # Обычный ответ
+        # Обычный ответ с известной длиной
+        try:
             data = await resp.aread()
-            return Response(content=data, status_code=status_code, media_type=content_type)
+        finally:
+            await resp.aclose()
+        return Response(content=data, status_code=status_code, media_type=content_type)
 
     except httpx.ConnectError as e:
         raise HTTPException(
@@ -212,39 +407,50 @@ async def _proxy(request: Request, path: str, authorization: Optional[str]) -> R
 # =============================================================================
 
 @app.api_route("/v1/chat/completions", methods=["POST"])
-async def chat_completions(
-    request: Request,
-    authorization: Optional[str] = Header(default=None)
-) -> Response:
+async def chat_completions(request: Request) -> Response:
     """Проксирует chat completions запросы."""
-    return await _proxy(request, "/v1/chat/completions", authorization)
+    return await _proxy(request, request.app.state.routes["/v1/chat/completions"])
 
 
 @app.api_route("/v1/completions", methods=["POST"])
-async def completions(
-    request: Request,
-    authorization: Optional[str] = Header(default=None)
-) -> Response:
+async def completions(request: Request) -> Response:
     """Проксирует completions запросы (legacy)."""
-    return await _proxy(request, "/v1/completions", authorization)
+    return await _proxy(request, request.app.state.routes["/v1/completions"])
 
 
 @app.api_route("/v1/models", methods=["GET"])
-async def models(
-    request: Request,
-    authorization: Optional[str] = Header(default=None)
-) -> Response:
-    """Проксирует запрос списка моделей."""
-    return await _proxy(request, "/v1/models", authorization)
+async def models(request: Request) -> Response:
+    """
+    Проксирует запрос списка моделей.
+    Успешный ответ кэшируется на MODELS_CACHE_TTL секунд;
+    запросы с query-параметрами идут к backend'у мимо кэша.
+    """
+    state = request.app.state
+    ttl = state.models_cache_ttl
+    if ttl <= 0 or request.query_params:
+        return await _proxy(request, state.routes["/v1/models"])
+
+    _auth_or_401(request)
+
+    cached = state.models_cache
+    if cached is None or time.monotonic() - cached[0] >= ttl:
+        async with state.models_lock:
+            cached = state.models_cache
+            if cached is None or time.monotonic() - cached[0] >= ttl:
+                resp = await _forward(request, state.routes["/v1/models"])
+                if resp.status_code != 200 or isinstance(resp, StreamingResponse):
+                    return resp
+                cached = (time.monotonic(), resp.body, resp.media_type, resp.status_code)
+                state.models_cache = cached
+
+    _, content, media_type, status_code = cached
+    return Response(content=content, status_code=status_code, media_type=media_type)
 
 
 @app.api_route("/v1/embeddings", methods=["POST"])
-async def embeddings(
-    request: Request,
-    authorization: Optional[str] = Header(default=None)
-) -> Response:
+async def embeddings(request: Request) -> Response:
     """Проксирует embeddings запросы (если backend поддерживает)."""
-    return await _proxy(request, "/v1/embeddings", authorization)
+    return await _proxy(request, request.app.state.routes["/v1/embeddings"])
 
 
 # =============================================================================
@@ -252,11 +458,12 @@ async def embeddings(
 # =============================================================================
 
 @app.get("/config")
-async def config() -> JSONResponse:
+async def config(request: Request) -> JSONResponse:
     """Возвращает текущую конфигурацию прокси (без секретов)."""
+    state = request.app.state
     return JSONResponse({
-        "backend": _get_llm_backend(),
-        "backend_url": _get_backend_base_url(),
-        "served_model_name": _get_served_model_name(),
-        "auth_enabled": bool(_get_api_key()),
+        "backend": state.backend,
+        "backend_url": state.base_url,
+        "served_model_name": state.served_model_name,
+        "auth_enabled": state.auth_enabled,
     })
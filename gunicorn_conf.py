@@ -0,0 +1,38 @@
+"""
+Конфигурация Gunicorn для API-прокси.
+
+Запуск:
+    gunicorn -c gunicorn_conf.py api_server:app
+
+Каждый воркер — отдельный процесс со своим event loop и своим пулом
+соединений к backend'у (создаётся в startup-хуке api_server).
+"""
+
+import os
+
+from uvicorn.workers import UvicornWorker
+
+
+class UvloopWorker(UvicornWorker):
+    """
+    Воркер с явными uvloop и httptools.
+    В отличие от "auto", при отсутствии пакетов воркер не стартует,
+    а не откатывается молча на asyncio и h11.
+    """
+
+    CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools"}
+
+
+# Адрес и порт прокси внутри контейнера
+bind = os.getenv("BIND", "0.0.0.0:8001")
+
+# Количество воркеров: WEB_CONCURRENCY или 2 * CPU + 1
+workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+worker_class = "gunicorn_conf.UvloopWorker"
+
+# Keep-alive с клиентами и время на корректное завершение воркеров
+keepalive = 75
+graceful_timeout = 30
+
+accesslog = "-"
+errorlog = "-"
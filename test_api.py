@@ -11,6 +11,8 @@
     LLM_BACKEND   - backend (vllm, ollama, llamacpp) — влияет на BASE_URL
     MODEL         - имя модели (если не задано — определяется автоматически)
     API_KEY       - API ключ (опционально)
+
+Если установлен orjson, он используется для (де)сериализации JSON.
 """
 
 import json
@@ -18,7 +20,18 @@ import os
 import sys
 import time
 
-import requests
+import httpx
+
+try:
+    import orjson
+
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:  # orjson не установлен — стандартный json
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+    json_loads = json.loads
 
 
 # URL по умолчанию для каждого backend'а
@@ -39,14 +52,26 @@ def get_base_url() -> str:
     return DEFAULT_URLS.get(backend, DEFAULT_URLS["vllm"])
 
 
-def sse_stream(resp: requests.Response):
-    """Генератор для парсинга SSE-потока."""
-    for line in resp.iter_lines(decode_unicode=True):
-        if not line:
-            continue
-        if line.startswith("data: "):
-            payload = line.removeprefix("data: ").strip()
-            if payload == "[DONE]":
+def sse_events(resp: httpx.Response):
+    """
+    Генератор для парсинга SSE-потока.
+    Работает с байтами: события разделяются пустой строкой, многострочные
+    data: склеиваются через перевод строки, прочие поля (event:, id:) пропускаются.
+    """
+    buf = b""
+    for chunk in resp.iter_bytes(8192):
+        buf = (buf + chunk).replace(b"\r\n", b"\n")
+        while b"\n\n" in buf:
+            event, buf = buf.split(b"\n\n", 1)
+            data_lines = [
+                line[5:].removeprefix(b" ")
+                for line in event.split(b"\n")
+                if line.startswith(b"data:")
+            ]
+            if not data_lines:
+                continue
+            payload = b"\n".join(data_lines)
+            if payload == b"[DONE]":
                 return
             yield payload
 
@@ -66,16 +91,29 @@ def main() -> int:
     print(f"Базовый URL: {base_url}")
     print("=" * 50)
 
+    # Одна сессия на все проверки: соединение переиспользуется между запросами
+    with httpx.Client(
+        base_url=base_url,
+        headers=headers,
+        timeout=30.0,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=10),
+    ) as session:
+        return run_checks(session, model)
+
+
+def run_checks(session: httpx.Client, model: str) -> int:
+    """Выполняет проверки API через общую сессию."""
     # =========================================================================
     # Проверка /health
     # =========================================================================
     print("\n[1] Проверка /health")
     try:
-        r = requests.get(f"{base_url}/health", timeout=5)
+        r = session.get("/health", timeout=5)
         print(f"    GET /health: {r.status_code}")
         if r.status_code == 200:
             print(f"    Ответ: {r.text[:200]}")
-    except requests.exceptions.ConnectionError:
+    except httpx.ConnectError:
         print("    /health недоступен (это нормально для некоторых backend'ов)")
     except Exception as e:
         print(f"    Ошибка: {e}")
@@ -85,14 +123,14 @@ def main() -> int:
     # =========================================================================
     print("\n[2] Получение списка моделей")
     try:
-        r = requests.get(f"{base_url}/v1/models", headers=headers, timeout=30)
+        r = session.get("/v1/models")
         print(f"    GET /v1/models: {r.status_code}")
 
         if r.status_code != 200:
             print(f"    Ошибка: {r.text}")
             return 1
 
-        models_data = r.json()
+        models_data = json_loads(r.content)
         available_models = models_data.get("data", [])
 
         if available_models:
@@ -131,10 +169,9 @@ def main() -> int:
 
     try:
         t0 = time.time()
-        r = requests.post(
-            f"{base_url}/v1/chat/completions",
-            headers=headers,
-            data=json.dumps(payload),
+        r = session.post(
+            "/v1/chat/completions",
+            content=json_dumps(payload),
             timeout=300,
         )
         dt = time.time() - t0
@@ -145,7 +182,7 @@ def main() -> int:
             print(f"    Ошибка: {r.text}")
             return 1
 
-        response_data = r.json()
+        response_data = json_loads(r.content)
         content = response_data["choices"][0]["message"]["content"]
         print(f"    Ответ: {content}")
 
@@ -171,21 +208,21 @@ def main() -> int:
     try:
         print("    Потоковый ответ: ", end="", flush=True)
 
-        with requests.post(
-            f"{base_url}/v1/chat/completions",
-            headers=headers,
-            data=json.dumps(payload),
-            stream=True,
+        with session.stream(
+            "POST",
+            "/v1/chat/completions",
+            content=json_dumps(payload),
             timeout=300,
         ) as r:
             if r.status_code != 200:
+                r.read()
                 print(f"\n    Ошибка: {r.status_code} {r.text}")
                 return 1
 
             collected = []
-            for data in sse_stream(r):
+            for data in sse_events(r):
                 try:
-                    obj = json.loads(data)
+                    obj = json_loads(data)
                     delta = obj["choices"][0].get("delta", {}).get("content", "")
                     if delta:
                         sys.stdout.write(delta)